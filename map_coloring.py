@@ -6,32 +6,88 @@ Source: Google OR-Tools Constraint Optimization
 This module solves the map coloring problem using constraint programming.
 """
 
+import argparse
+import hashlib
+import os
+import sys
 import time
+from pathlib import Path
 from ortools.sat.python import cp_model
 
+# Version of the model built by build_model. It is part of the cache file
+# names, so it must be bumped whenever the model changes, or cached files of
+# the old model would still be loaded.
+MODEL_VERSION = 2
+
+
+def write_solution(data):
+    """
+    Writes one encoded coloring to stdout, the same way as in n_queens.py.
+
+    Parameters:
+    data (bytes): The encoded text of the coloring.
+    """
+    buffer = getattr(sys.stdout, "buffer", None)
+    if buffer is None:
+        sys.stdout.write(data.decode())
+    else:
+        buffer.write(data)
+
+
+def format_solution(solution_count, start_time, coloring, colors, verbose):
+    """
+    Formats one coloring the way both solvers print it.
+
+    Parameters:
+    solution_count (int): The number of the solution.
+    start_time (float): The time.perf_counter() value at the start of the
+    search, used for the elapsed time.
+    coloring (iterable): Pairs of a state and its color index.
+    colors (list): A list of available colors.
+    verbose (bool): If True, the elapsed time is always in the header;
+    otherwise only for every 1024th solution.
+    Returns the encoded text, so it can be written with a single call.
+    """
+    if verbose or solution_count % 1024 == 0:
+        current_time = time.perf_counter()
+        header = (
+            f"Solution {solution_count}, "
+            f"time = {current_time - start_time} s\n"
+        )
+    else:
+        header = f"Solution {solution_count}\n"
+    lines = "".join(f"{state}: {colors[color]}\n" for state, color in coloring)
+    return (header + lines + "\n").encode()
+
 
 class MapColoringSolutionPrinter(cp_model.CpSolverSolutionCallback):
     """Print intermediate solutions for the Map Coloring problem."""
 
-    def __init__(self, states, colors):
+    def __init__(self, states, colors, verbose=False):
         """
         __init__ Initializes the MapColoringSolutionPrinter constructor.
         attribute self has the parameter
         Parameters:
         attribute self has the parameter states (dict): A dictionary
-        containing the states and their corresponding color variables.
+        containing the states and their corresponding color variables. It is
+        stored as two parallel tuples, state_names and state_vars, so the
+        callback iterates over them without going through the dictionary.
         attribute self has the parameter colors (list): A list of
         available colors.
         attribute self has the parameter solution_count (int):
         The number of solutions found.
         attribute self has the parameter start_time (float):
         This is likely used to measure the time it takes to find solutions.
+        verbose (bool): If True, the elapsed time is printed with every
+        solution; otherwise only with every 1024th one.
         """
         cp_model.CpSolverSolutionCallback.__init__(self)
-        self.__states = states
+        self.__state_names = tuple(states.keys())
+        self.__state_vars = tuple(states.values())
         self.__colors = colors
         self.__solution_count = 0
-        self.__start_time = time.time()
+        self.__verbose = verbose
+        self.__start_time = time.perf_counter()
 
     def solution_count(self):
         """
@@ -46,35 +102,258 @@ class MapColoringSolutionPrinter(cp_model.CpSolverSolutionCallback):
         used as a callback during the solving process of a constraint
         programming problem
         the current_time(float)  variable stores the current time using
-        the time.time() function.
+        the time.perf_counter() function.
         It is used to calculate the elapsed time since the start of
         the solving process.
         print() # statements:Purpose: These print statements output
         information about the current solution.
         the self.__solution_count(int) variable is incremented by 1.
-        and self.__states.items(Dict) is used to iterate through the states
-        self.Value(color_var(int)) is used to get the value of
-        the color variable.
+        and self.__state_names(tuple) is walked alongside the values of
+        self.__state_vars(tuple), read with self.Value, to get the color
+        of each state.
         and finally, the print() statement is used to print
         the state and its color.
         """
-        current_time = time.time()
-        print(
-            f"Solution {self.__solution_count}, "
-            f"time = {current_time - self.__start_time} s"
+        # Binds the attributes to locals once instead of resolving them for
+        # every state.
+        solution_count = self.__solution_count
+        state_names = self.__state_names
+        state_vars = self.__state_vars
+        self.__solution_count = solution_count + 1
+
+        coloring = zip(state_names, map(self.Value, state_vars))
+        write_solution(
+            format_solution(
+                solution_count,
+                self.__start_time,
+                coloring,
+                self.__colors,
+                self.__verbose,
+            )
         )
+
+
+class MapColoringSolutionCounter(cp_model.CpSolverSolutionCallback):
+    """Counts the Map Coloring solutions without printing them."""
+
+    def __init__(self):
+        """
+        Initializes the MapColoringSolutionCounter constructor.
+        attribute self has the parameter solution_count (int): The number of
+        solutions found. No variable values are read, so each callback only
+        increments the counter.
+        """
+        cp_model.CpSolverSolutionCallback.__init__(self)
+        self.__solution_count = 0
+
+    def solution_count(self):
+        """
+        Returns the number of solutions found so far.
+        """
+        return self.__solution_count
+
+    def on_solution_callback(self):
+        """
+        Increments the solution count.
+        """
         self.__solution_count += 1
 
-        for state, color_var in self.__states.items():
-            color = self.Value(color_var)
-            print(state + ": " + self.__colors[color])
-        print()
 
+def clique_cover(neighbors):
+    """
+    Covers every edge of the constraint graph with cliques.
+
+    Parameters:
+    neighbors (dict): A dictionary mapping each state to its neighboring
+    states.
+    Each edge is first stored once as a sorted pair, so an edge listed from
+    both of its states is only considered one time. Starting from an edge
+    that is not covered yet, the clique is grown greedily with every state
+    adjacent to all of its members.
+    Returns a list of cliques, each one a tuple of states.
+    """
+    edges = {
+        tuple(sorted((state, neighbor)))
+        for state, state_neighbors in neighbors.items()
+        for neighbor in state_neighbors
+    }
+    adjacent = {
+        state: set(state_neighbors)
+        for state, state_neighbors in neighbors.items()
+    }
+
+    cliques = []
+    covered = set()
+    for edge in sorted(edges):
+        if edge in covered:
+            continue
+        clique = list(edge)
+        for state in neighbors:
+            if state not in clique and all(
+                state in adjacent[member] for member in clique
+            ):
+                clique.append(state)
+        cliques.append(tuple(clique))
+        covered.update(
+            tuple(sorted((a, b))) for a in clique for b in clique if a != b
+        )
+    return cliques
+
+
+def enumerate_colorings(neighbors, num_colors):
+    """
+    Yields the colorings of the constraint graph found by backtracking.
 
-def main():
+    Parameters:
+    neighbors (dict): A dictionary mapping each state to its neighboring
+    states.
+    num_colors (int): The number of available colors.
+    States are colored in the order of neighbors, trying for each one every
+    color not used by an already colored neighbor. A state may only take a
+    color already used or the next unused one, so colorings that only differ
+    by a relabeling of the colors are yielded once. build_model posts the
+    same ordering, so both solvers report the same colorings for any map
+    and number of colors.
+    Each coloring is a dictionary mapping each state to its color index.
+    """
+    states = list(neighbors)
+    coloring = {}
+
+    def color_from(index, used_colors):
+        if index == len(states):
+            yield dict(coloring)
+            return
+        state = states[index]
+        taken = {
+            coloring[neighbor]
+            for neighbor in neighbors[state]
+            if neighbor in coloring
+        }
+        for color in range(min(num_colors, used_colors + 1)):
+            if color not in taken:
+                coloring[state] = color
+                yield from color_from(index + 1, max(used_colors, color + 1))
+                del coloring[state]
+
+    yield from color_from(0, 0)
+
+
+def build_model(mainland_states, colors, break_symmetry=True):
+    """
+    Builds the Map Coloring model.
+
+    Parameters:
+    mainland_states (dict): A dictionary mapping each state to its
+    neighboring states.
+    colors (list): A list of available colors.
+    break_symmetry (bool): If True, each state, in the order of
+    mainland_states, may only take a color already used by an earlier state
+    or the next unused one, so colorings that only differ by a relabeling of
+    the colors are reported once. This is the same ordering as
+    enumerate_colorings uses.
+    Returns the model and a dictionary mapping each state to its color
+    variable. The variables are created in the order of mainland_states.
+    """
+    model = cp_model.CpModel()
+
+    # Create variables for each state
+    state_colors = {
+        state: model.NewIntVar(0, len(colors) - 1, state)
+        for state in mainland_states
+    }
+
+    # Break the color symmetry: any coloring can have its colors relabeled so
+    # that colors are first used in increasing order, so only one coloring
+    # per permutation of the colors is enumerated. used_max is the largest
+    # color of the states before the current one.
+    states = list(mainland_states)
+    if break_symmetry and states:
+        model.Add(state_colors[states[0]] == 0)
+        used_max = state_colors[states[0]]
+        for state in states[1:]:
+            model.Add(state_colors[state] <= used_max + 1)
+            if state != states[-1]:
+                next_max = model.NewIntVar(0, len(colors) - 1, "max_" + state)
+                model.AddMaxEquality(next_max, [used_max, state_colors[state]])
+                used_max = next_max
+
+    # Add constraints
+    # Neighboring states forming a clique all need different colors, so one
+    # AllDifferent per clique replaces the pairwise inequalities.
+    for clique in clique_cover(mainland_states):
+        model.AddAllDifferent([state_colors[state] for state in clique])
+
+    return model, state_colors
+
+
+def load_model(mainland_states, colors, cache_dir=None):
+    """
+    Returns the Map Coloring model, optionally cached on disk.
+
+    Parameters:
+    mainland_states (dict): A dictionary mapping each state to its
+    neighboring states.
+    colors (list): A list of available colors.
+    cache_dir (str): If given, the model of build_model is saved in this
+    directory to a file named after MODEL_VERSION and a hash of the map and
+    the colors, and later runs parse that file instead of building the model
+    again. Without it the model is simply built.
+    Returns the model and a dictionary mapping each state to its color
+    variable.
+    """
+    if cache_dir is None:
+        return build_model(mainland_states, colors)
+
+    key = hashlib.sha256(
+        repr((list(mainland_states.items()), colors)).encode()
+    ).hexdigest()[:16]
+    cache = Path(cache_dir) / f"map_coloring_v{MODEL_VERSION}_{key}.pb"
+    if not cache.exists():
+        model, state_colors = build_model(mainland_states, colors)
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        partial = cache.with_name(f"{cache.name}.{os.getpid()}")
+        partial.write_bytes(model.Proto().SerializeToString())
+        os.replace(partial, cache)
+        return model, state_colors
+
+    model = cp_model.CpModel()
+    model.Proto().ParseFromString(cache.read_bytes())
+    # The variables were created in the order of mainland_states.
+    state_colors = {
+        state: model.GetIntVarFromProtoIndex(index)
+        for index, state in enumerate(mainland_states)
+    }
+    return model, state_colors
+
+
+def main(
+    count_only=False,
+    enumerate_all=True,
+    use_cpsat=False,
+    verbose=False,
+    workers=None,
+    export_proto=None,
+    cache_dir=None,
+):
     """
     Solves the Map Coloring problem and prints solutions.
 
+    Parameters:
+    count_only (bool): If True, the solutions are only counted, not printed.
+    enumerate_all (bool): If True, all solutions are enumerated on a single
+    search worker; otherwise the search stops at the first solution and runs
+    on one worker per CPU.
+    use_cpsat (bool): If True, the CP-SAT solver is used; otherwise the
+    colorings are enumerated directly with enumerate_colorings, which avoids
+    the solver startup cost on a map this small.
+    verbose (bool): If True, the elapsed time is printed with every solution.
+    workers (int): The number of CP-SAT search workers when enumerate_all is
+    False; by default one per CPU. Only used with use_cpsat.
+    export_proto (str): If given, the model proto is written to this path
+    instead of being solved, for tools that read CP-SAT models directly.
+    The exported model has no symmetry breaking, so it has every solution.
+    cache_dir (str): If given, the model is cached in this directory by
+    load_model.
     The function defines Australia's mainland states and their neighbors,
     creates variables for each state and adds constraints to ensure
     neighboring states.
@@ -110,26 +389,60 @@ def main():
     # Define the available colors
     colors = ["Red", "Green", "Blue"]
 
-    # Create the solver
-    model = cp_model.CpModel()
+    if not use_cpsat and not export_proto:
+        start_time = time.perf_counter()
+        solution_count = 0
+        sys.stdout.flush()
+        for coloring in enumerate_colorings(mainland_states, len(colors)):
+            if not count_only:
+                write_solution(
+                    format_solution(
+                        solution_count,
+                        start_time,
+                        coloring.items(),
+                        colors,
+                        verbose,
+                    )
+                )
+            solution_count += 1
+            if not enumerate_all:
+                break
 
-    # Create variables for each state
-    state_colors = {
-        state: model.NewIntVar(0, len(colors) - 1, state)
-        for state in mainland_states
-    }
+        print("\nStatistics")
+        print(f"  wall time      : {time.perf_counter() - start_time} s")
+        print(f"  solutions found: {solution_count}")
+        return
 
-    # Add constraints
-    for state, neighbors in mainland_states.items():
-        for neighbor in neighbors:
-            model.Add(state_colors[state] != state_colors[neighbor])
+    if export_proto:
+        # The full model is exported, so its solutions include every
+        # relabeling of the colors.
+        model, _ = build_model(mainland_states, colors, break_symmetry=False)
+        Path(export_proto).write_bytes(model.Proto().SerializeToString())
+        print(f"Model written to {export_proto}")
+        return
+
+    # Create the model
+    model, state_colors = load_model(mainland_states, colors, cache_dir)
 
     # Create the solver and solution printer
     solver = cp_model.CpSolver()
-    solution_printer = MapColoringSolutionPrinter(state_colors, colors)
-    solver.parameters.enumerate_all_solutions = True
+    if count_only:
+        solution_printer = MapColoringSolutionCounter()
+    else:
+        solution_printer = MapColoringSolutionPrinter(
+            state_colors, colors, verbose
+        )
+    solver.parameters.enumerate_all_solutions = enumerate_all
+    # Enumeration needs a single worker; a first solution is found faster by
+    # the parallel portfolio search.
+    if enumerate_all:
+        solver.parameters.num_search_workers = 1
+    else:
+        solver.parameters.num_search_workers = workers or os.cpu_count() or 1
+    solver.parameters.log_search_progress = False
 
     # Solve the model
+    sys.stdout.flush()
     solver.Solve(model, solution_printer)
 
     # Statistics
@@ -141,4 +454,60 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(
+        description="Solves the Map Coloring problem."
+    )
+    parser.add_argument(
+        "--count-only",
+        action="store_true",
+        help="count the solutions without printing the colorings",
+    )
+    parser.add_argument(
+        "--solver",
+        choices=["backtrack", "cpsat"],
+        default="backtrack",
+        help="enumerate the colorings directly or with the CP-SAT solver",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="print the elapsed time with every solution",
+    )
+    parser.add_argument(
+        "--no-enumerate",
+        action="store_true",
+        help="stop at the first solution instead of enumerating all of them",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of search workers, only with --solver cpsat and "
+        "--no-enumerate",
+    )
+    parser.add_argument(
+        "--export-proto",
+        metavar="PATH",
+        help="write the full model proto, without symmetry breaking, to PATH "
+        "instead of solving it",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        metavar="DIR",
+        help="cache the built model proto in DIR between runs",
+    )
+    args = parser.parse_args()
+    # CP-SAT rejects models enumerating all solutions on several workers.
+    if args.workers is not None and not args.no_enumerate:
+        parser.error("--workers requires --no-enumerate")
+    # The backtracking enumeration runs on a single thread.
+    if args.workers is not None and args.solver != "cpsat":
+        parser.error("--workers requires --solver cpsat")
+    main(
+        args.count_only,
+        enumerate_all=not args.no_enumerate,
+        use_cpsat=args.solver == "cpsat",
+        verbose=args.verbose,
+        workers=args.workers,
+        export_proto=args.export_proto,
+        cache_dir=args.cache_dir,
+    )